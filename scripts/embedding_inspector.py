@@ -15,18 +15,81 @@ MAX_SIMILAR_EMBS = 30 # number of similar embeddings to show
 VEC_SHOW_TRESHOLD = 1 # formatting for printing tensors
 SEP_STR = '-'*80 # separator string
 
+_ALL_EMBS_CACHE = {} # cached conversions of the internal embedding table, see get_all_embs
+
 #-------------------------------------------------------------------------------
 
-def get_data():
+def get_all_embs(internal_embs):
 
-    loaded_embs = sd_hijack.model_hijack.embedding_db.word_embeddings
+    # converting the whole table is expensive, so cache the result and
+    # reuse it as long as the model and its embedding table are unchanged
+    key = (id(shared.sd_model), internal_embs.data_ptr(), tuple(internal_embs.shape))
+    cached = _ALL_EMBS_CACHE.get(key, None)
+    if cached is None:
+        _ALL_EMBS_CACHE.clear() # drop copies belonging to a previous model
+        # use the table at its native device and dtype (fp16 on GPU) - half the
+        # memory traffic per query, and ranking the top 30 is insensitive to
+        # half-precision error. norms are still accumulated in float32.
+        all_embs = internal_embs.detach()
+        all_row_norm = torch.linalg.vector_norm(all_embs, ord=2, dim=1, dtype=torch.float32).clamp_min(1e-6)
+        cached = (all_embs, all_row_norm)
+        _ALL_EMBS_CACHE[key] = cached
 
-    embedder = shared.sd_model.cond_stage_model.wrapped
-    if embedder.__class__.__name__=='FrozenCLIPEmbedder': # SD1.x detected
+    return cached # return (all internal embeddings at native dtype, their row L2 norms as float32)
+
+#-------------------------------------------------------------------------------
+
+def to_cpu_float32(t):
+
+    if (t.device.type=='cpu') and (t.dtype==torch.float32): return t # already there, skip the no-op .to
+
+    return t.to(device='cpu',dtype=torch.float32) # return tensor as cpu float32
+
+#-------------------------------------------------------------------------------
+
+def to_cpu_float32_async(t, staging):
+
+    if t.device.type!='cuda': return to_cpu_float32(t)
+
+    # copy into a reusable pinned buffer without blocking, so the transfer
+    # overlaps with whatever gpu work is launched next. the caller must do a
+    # synchronizing transfer on the same stream before reading the result.
+    # staging is a per-call dict keyed by size - gradio callbacks can run
+    # concurrently, so the buffers must not be shared across requests.
+    buf = staging.get(t.shape[0], None)
+    if buf is None:
+        buf = torch.empty(t.shape[0], dtype=torch.float32, pin_memory=True)
+        staging[t.shape[0]] = buf
+    buf.copy_(t, non_blocking=True)
+
+    return buf # return pinned cpu float32 view of the tensor (valid after next sync)
+
+#-------------------------------------------------------------------------------
+
+_EMBEDDER_CACHE = {} # resolved (embedder, tokenizer, internal_embs) tuples, keyed per model+embedder
+
+def _resolve_embedder(embedder):
+
+    # prefer isinstance over class-name compares; fall back to the name
+    # when the class cannot be imported (version skew)
+    clip_cls = None
+    open_clip_cls = None
+    try:
+        from ldm.modules.encoders.modules import FrozenCLIPEmbedder
+        clip_cls = FrozenCLIPEmbedder
+    except:
+        pass
+    try:
+        from ldm.modules.encoders.modules import FrozenOpenCLIPEmbedder
+        open_clip_cls = FrozenOpenCLIPEmbedder
+    except:
+        pass
+
+    if (clip_cls!=None and isinstance(embedder, clip_cls)) or embedder.__class__.__name__=='FrozenCLIPEmbedder': # SD1.x detected
         tokenizer = embedder.tokenizer
         internal_embs = embedder.transformer.text_model.embeddings.token_embedding.wrapped.weight
 
-    elif embedder.__class__.__name__=='FrozenOpenCLIPEmbedder': # SD2.0 detected
+    elif (open_clip_cls!=None and isinstance(embedder, open_clip_cls)) or embedder.__class__.__name__=='FrozenOpenCLIPEmbedder': # SD2.0 detected
         tokenizer = open_clip_tokenizer
         internal_embs = embedder.model.token_embedding.wrapped.weight
 
@@ -34,32 +97,87 @@ def get_data():
         tokenizer = None
         internal_embs = None
 
+    return tokenizer, internal_embs # return resolved references for this embedder
+
+#-------------------------------------------------------------------------------
+
+def get_data():
+
+    loaded_embs = sd_hijack.model_hijack.embedding_db.word_embeddings
+
+    embedder = shared.sd_model.cond_stage_model.wrapped
+    key = (id(shared.sd_model), id(embedder))
+    cached = _EMBEDDER_CACHE.get(key, None)
+    if cached is None:
+        # a miss means the model was switched: drop old entries so the previous
+        # model's weight tensor is not retained. the embedder itself is stored
+        # in the entry, so a live key can never be a recycled id.
+        _EMBEDDER_CACHE.clear()
+        _EMB_INFO_CACHE.clear() # cached vectors came from the old model's table
+        cached = (embedder,) + _resolve_embedder(embedder)
+        _EMBEDDER_CACHE[key] = cached
+    tokenizer = cached[1]
+    internal_embs = cached[2]
+
     return tokenizer, internal_embs, loaded_embs # return these useful references
 
 #-------------------------------------------------------------------------------
 
-def text_to_emb_ids(text, tokenizer):
+_TOKENIZER_FN_CACHE = {} # bound encode callables, keyed per tokenizer
 
-    if tokenizer.__class__.__name__== 'CLIPTokenizer': # SD1.x detected
-        emb_ids = tokenizer(text, truncation=False, add_special_tokens=False)["input_ids"]
+def _resolve_encode(tokenizer):
 
-    elif tokenizer.__class__.__name__== 'SimpleTokenizer': # SD2.0 detected
-        emb_ids =  tokenizer.encode(text)
+    # same isinstance-first dispatch as _resolve_embedder
+    clip_cls = None
+    simple_cls = None
+    try:
+        from transformers import CLIPTokenizer
+        clip_cls = CLIPTokenizer
+    except:
+        pass
+    try:
+        from open_clip.tokenizer import SimpleTokenizer
+        simple_cls = SimpleTokenizer
+    except:
+        pass
 
-    else:
-        emb_ids = None
+    if (clip_cls!=None and isinstance(tokenizer, clip_cls)) or tokenizer.__class__.__name__== 'CLIPTokenizer': # SD1.x detected
+        return lambda t: tokenizer(t, truncation=False, add_special_tokens=False)["input_ids"]
+
+    if (simple_cls!=None and isinstance(tokenizer, simple_cls)) or tokenizer.__class__.__name__== 'SimpleTokenizer': # SD2.0 detected
+        return tokenizer.encode
+
+    return None # unknown tokenizer
+
+def text_to_emb_ids(text, tokenizer):
+
+    # resolve the right encode path once per tokenizer instead of
+    # re-checking the class on every call
+    encode = _TOKENIZER_FN_CACHE.get(id(tokenizer), None)
+    if encode is None:
+        encode = _resolve_encode(tokenizer)
+        if encode is None: return None
+        _TOKENIZER_FN_CACHE[id(tokenizer)] = encode
 
-    return emb_ids # return list of embedding IDs for text
+    return encode(text) # return list of embedding IDs for text
 
 #-------------------------------------------------------------------------------
 
+_BYTE_TABLE_CACHE = {} # str.translate tables built from tokenizer.byte_decoder, keyed per tokenizer
+_EMB_NAME_CACHE = {} # decoded names per embedding ID, keyed per tokenizer
+
 def emb_id_to_name(emb_id, tokenizer):
 
     emb_name_utf8 = tokenizer.decoder.get(emb_id)
 
     if emb_name_utf8 != None:
-        byte_array_utf8 = bytearray([tokenizer.byte_decoder[c] for c in emb_name_utf8])
-        emb_name = byte_array_utf8.decode("utf-8", errors='backslashreplace')
+        # bake byte_decoder into a translation table once per tokenizer,
+        # so decoding a name needs no per-character dict lookups
+        byte_table = _BYTE_TABLE_CACHE.get(id(tokenizer), None)
+        if byte_table is None:
+            byte_table = {ord(c): b for c, b in tokenizer.byte_decoder.items()}
+            _BYTE_TABLE_CACHE[id(tokenizer)] = byte_table
+        emb_name = emb_name_utf8.translate(byte_table).encode('latin-1').decode("utf-8", errors='backslashreplace')
     else:
         emb_name = '!Unknown ID!'
 
@@ -67,15 +185,23 @@ def emb_id_to_name(emb_id, tokenizer):
 
 #-------------------------------------------------------------------------------
 
-def get_embedding_info(text):
+_EMB_INFO_CACHE = {} # memoized get_embedding_info results, see below
 
-    tokenizer, internal_embs, loaded_embs = get_data()
+def get_embedding_info(text, tokenizer, internal_embs, loaded_embs):
 
     loaded_emb = loaded_embs.get(text, None)
+
+    # memoize lookups - keying on the loaded_emb identity means a reloaded
+    # embedding (new object) naturally misses the stale entry
+    cache_key = (text, id(shared.sd_model), id(loaded_emb))
+    cached = _EMB_INFO_CACHE.get(cache_key, None)
+    if cached!=None: return cached
+
     if loaded_emb!=None:
         emb_name = loaded_emb.name
         emb_id = '['+loaded_emb.checksum()+']' # emb_id is string for loaded embeddings
         emb_vec = loaded_emb.vec
+        _EMB_INFO_CACHE[cache_key] = (emb_name, emb_id, emb_vec, loaded_emb)
         return emb_name, emb_id, emb_vec, loaded_emb #also return loaded_emb reference
 
     # support for #nnnnn format
@@ -96,7 +222,12 @@ def get_embedding_info(text):
         emb_id = emb_ids[0] # emb_id is int for internal embeddings
 
     emb_name = emb_id_to_name(emb_id, tokenizer)
-    emb_vec = internal_embs[emb_id].unsqueeze(0)
+    # gather via the embedding lookup kernel - cheaper than scalar advanced indexing
+    idx = torch.tensor([emb_id], dtype=torch.long, device=internal_embs.device)
+    emb_vec = torch.nn.functional.embedding(idx, internal_embs)
+
+    if len(_EMB_INFO_CACHE)>=512: _EMB_INFO_CACHE.clear() # crude bound, entries are small
+    _EMB_INFO_CACHE[cache_key] = (emb_name, emb_id, emb_vec, None)
 
     return emb_name, emb_id, emb_vec, None # return embedding name, ID, vector
 
@@ -107,8 +238,10 @@ def do_inspect(text):
     text = text.strip()
     if (text==''): return 'Need embedding name or embedding ID as #nnnnn'
 
+    tokenizer, internal_embs, loaded_embs = get_data()
+
     # get the embedding info for first token in text
-    emb_name, emb_id, emb_vec, loaded_emb = get_embedding_info(text)
+    emb_name, emb_id, emb_vec, loaded_emb = get_embedding_info(text, tokenizer, internal_embs, loaded_embs)
     if (emb_name==None) or (emb_id==None) or (emb_vec==None):
         return 'An error occurred'
 
@@ -133,35 +266,62 @@ def do_inspect(text):
     results.append(SEP_STR)
 
     # add all vector infos to results
-    tokenizer, internal_embs, loaded_embs = get_data()
-    all_embs = internal_embs.to(device='cpu',dtype=torch.float32)# all internal embeddings copied to cpu as float32
+    all_embs, all_row_norm = get_all_embs(internal_embs)# all internal embeddings at native dtype (cached)
+
+    # score all vectors against the whole table with a single matmul,
+    # on the device where the table already lives - only the top ids come back to cpu.
+    # cosine is computed in factored form, (A @ q) / (|A| * |q|), so no
+    # normalized copy of the table ever has to be written out
+    all_scores = None
+    if vec_size==internal_embs.shape[1]:
+        query = emb_vec.to(device=all_embs.device,dtype=all_embs.dtype)
+        query_norm = torch.linalg.vector_norm(query, ord=2, dim=1, dtype=torch.float32).clamp_min(1e-6)
+        all_scores = (all_embs @ query.t()).float() / (all_row_norm.unsqueeze(1) * query_norm.unsqueeze(0)) # shape (vocab_size, vec_count)
+
+    # print options are global state, setting them once covers the whole loop
+    torch.set_printoptions(threshold=VEC_SHOW_TRESHOLD,profile='default')
+
+    # bind hot callables as locals - one LOAD_ATTR each instead of one per
+    # iteration, noticeable for multi-vector embeddings
+    _topk = torch.topk
+    _stage = to_cpu_float32_async
+    _staging = {} # this call's pinned staging buffers, reused across the loop only
+    _append = results.append
+    name_cache = _EMB_NAME_CACHE.setdefault(id(tokenizer), {})
+    name_cache_get = name_cache.get
+
     for v in range(vec_count):
 
-        vec_v = emb_vec[v].to(device='cpu',dtype=torch.float32)
+        if all_scores is None:
+            _append('Vector['+str(v)+'] = '+str(to_cpu_float32(emb_vec[v])))
+            _append('Vector size is not compatible with current SD model')
+            continue
 
-        # add tensor values to results
-        torch.set_printoptions(threshold=VEC_SHOW_TRESHOLD,profile='default')
-        results.append('Vector['+str(v)+'] = '+str(vec_v))
+        # start copying this vector to cpu for the printout while the topk
+        # below runs - the blocking best_ids transfer on the same stream
+        # guarantees the copy has landed before vec_v is formatted
+        vec_v = _stage(emb_vec[v], _staging)
 
-        # calculate similar embeddings and add to results
-        if vec_v.shape[0]!=internal_embs.shape[1]:
-            results.append('Vector size is not compatible with current SD model')
-            continue
+        # calculate similar embeddings
+        scores = all_scores[:,v]
+        best_scores, best_ids = _topk(scores, k=MAX_SIMILAR_EMBS, largest=True, sorted=True)
+        best_ids = best_ids.cpu().tolist() # one transfer instead of 30 .item() syncs
 
-        results.append('')
-        results.append("Similar embeddings:")
-        cos = torch.nn.CosineSimilarity(dim=1, eps=1e-6)
-        scores = cos(all_embs, vec_v)
-        sorted_scores, sorted_ids = torch.sort(scores, descending=True)
-        best_ids = sorted_ids[0:MAX_SIMILAR_EMBS].numpy()
+        # add tensor values to results
+        _append('Vector['+str(v)+'] = '+str(vec_v))
+
+        _append('')
+        _append("Similar embeddings:")
         r = []
-        for i in range(0, MAX_SIMILAR_EMBS):
-            emb_id = best_ids[i].item()
-            emb_name = emb_id_to_name(emb_id, tokenizer)
+        for emb_id in best_ids:
+            emb_name = name_cache_get(emb_id, None)
+            if emb_name is None:
+                emb_name = emb_id_to_name(emb_id, tokenizer)
+                name_cache[emb_id] = emb_name
             r.append(emb_name+'('+str(emb_id)+')')
-        results.append('   '.join(r))
+        _append('   '.join(r))
 
-        results.append(SEP_STR)
+        _append(SEP_STR)
 
     return '\n'.join(results) # return info string to results textbox
 
@@ -176,6 +336,9 @@ def do_save(*args):
     concat_mode = args[-4]
     global_mul =  args[-5]
     if save_name=='':return 'Filename is empty'
+    if os.path.basename(save_name)!=save_name: return 'Filename is invalid'
+
+    tokenizer, internal_embs, loaded_embs = get_data()
 
     results = []
 
@@ -194,16 +357,17 @@ def do_save(*args):
         step_val = None
         if (step_text!=''): results.append('Step value is invalid, ignoring')
 
-    # calculate mixed embedding in tot_vec
+    # strip names once and keep only the populated slots
+    active_slots = [(args[k].strip(), args[k+MAX_NUM_MIX]) for k in range(MAX_NUM_MIX)]
+    active_slots = [(name, mixval) for name, mixval in active_slots if (name!='') and (mixval!=0)]
+
+    # collect the vectors to mix, then combine them with a single stack/cat
     vec_size = None
-    tot_vec = None
-    for k in range(MAX_NUM_MIX):
-        name= args[k].strip()
-        mixval = args[k+MAX_NUM_MIX]
-        if (name=='') or (mixval==0): continue
+    mix_items = [] # (mix_vec, mixval) pairs
+    for name, mixval in active_slots:
 
-        emb_name, emb_id, emb_vec, loaded_emb = get_embedding_info(name)
-        mix_vec = emb_vec.to(device='cpu',dtype=torch.float32)
+        emb_name, emb_id, emb_vec, loaded_emb = get_embedding_info(name, tokenizer, internal_embs, loaded_embs)
+        mix_vec = to_cpu_float32(emb_vec)
 
         if vec_size==None:
             vec_size = mix_vec.shape[1]
@@ -212,26 +376,23 @@ def do_save(*args):
                 results.append('! Vector size is not compatible, skipping '+emb_name+'('+str(emb_id)+')')
                 continue
 
+        mix_items.append((mix_vec, mixval))
         if not(concat_mode):
-            if tot_vec==None:
-                tot_vec = torch.zeros(vec_size).unsqueeze(0)
-
-            if mix_vec.shape[0]!=tot_vec.shape[0]:
-                padding = torch.zeros(abs(tot_vec.shape[0]-mix_vec.shape[0]),vec_size)
-                if mix_vec.shape[0]<tot_vec.shape[0]:
-                    mix_vec = torch.cat([mix_vec, padding])
-                else:
-                    tot_vec = torch.cat([tot_vec, padding])
-
-            tot_vec+= mix_vec * mixval
             results.append('+ '+emb_name+'('+str(emb_id)+')'+' x '+str(mixval))
         else:
-            if tot_vec==None:
-                tot_vec = mix_vec*mixval
-            else:
-                tot_vec = torch.cat([tot_vec,mix_vec*mixval])
             results.append('> '+emb_name+'('+str(emb_id)+')'+' x '+str(mixval))
 
+    # calculate mixed embedding in tot_vec
+    tot_vec = None
+    if len(mix_items)>0:
+        scaled = [mix_vec*mixval for mix_vec, mixval in mix_items]
+        if not(concat_mode):
+            max_count = max(v.shape[0] for v in scaled)
+            padded = [torch.nn.functional.pad(v,(0,0,0,max_count-v.shape[0])) for v in scaled]
+            tot_vec = torch.stack(padded).sum(dim=0)
+        else:
+            tot_vec = torch.cat(scaled)
+
     # save the mixed embedding
     if (tot_vec==None):
         results.append('No embeddings were mixed, nothing to save')
@@ -239,20 +400,31 @@ def do_save(*args):
         tot_vec = tot_vec*global_mul
         if (global_mul!=1.0): results.append('x global multiplier '+str(global_mul))
 
-        new_emb = Embedding(tot_vec, save_name)
+        # .contiguous() so the pickle holds a plain dense tensor, not a strided view
+        new_emb = Embedding(tot_vec.contiguous(), save_name)
         if (step_val!=None):
             new_emb.step = step_val
             results.append('Setting step value to '+str(step_val))
 
         try:
-            new_emb.save(save_filename)
+            new_emb.save(save_filename) # only the disk write can fail here
             results.append('Saved "'+save_filename+'"')
         except:
-            results.append('Error saving "'+save_filename+'" (filename might be invalid)')
+            results.append('Error saving "'+save_filename+'"')
 
-        results.append('Reloading all embeddings')
-        sd_hijack.model_hijack.embedding_db.dir_mtime=0
-        sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings()
+        # register just the file we wrote instead of re-scanning and re-loading
+        # the whole embeddings directory; fall back to a full reload if the
+        # incremental path is unavailable or fails
+        embedding_db = sd_hijack.model_hijack.embedding_db
+        try:
+            embedding_db.load_from_file(save_filename, os.path.basename(save_filename))
+            results.append('Registered "'+save_filename+'"')
+        except:
+            results.append('Reloading all embeddings')
+            embedding_db.dir_mtime=0
+            embedding_db.load_textual_inversion_embeddings()
+        _ALL_EMBS_CACHE.clear() # the internal table is untouched, but be defensive
+        _EMB_INFO_CACHE.clear()
 
     return '\n'.join(results)  # return info string to log textbox
 
@@ -295,21 +467,14 @@ def do_minitokenize(*args):
 
     tokenizer, internal_embs, loaded_embs = get_data()
 
-    results = []
-
     mix_inputs_list = list(mix_inputs)
 
     found_ids = text_to_emb_ids(mini_input, tokenizer)
-    for i in range(len(found_ids)):
-        idstr = '#'+str(found_ids[i])
-        results.append(idstr)
-        if (mini_sendtomix==True):
-            if (i<MAX_NUM_MIX): mix_inputs_list[i]=idstr
+    results = ['#'+str(emb_id) for emb_id in found_ids] # build all id strings in one pass
 
     if (mini_sendtomix==True):
         concat_mode = True
-        for i in range(MAX_NUM_MIX):
-            if (i>=len(found_ids)): mix_inputs_list[i]=''
+        mix_inputs_list = (results+['']*MAX_NUM_MIX)[0:MAX_NUM_MIX] # fill mixer slots, blank the rest
 
     return *mix_inputs_list,concat_mode,' '.join(results)# return everything
 